@@ -4,12 +4,16 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from statsmodels.tsa.holtwinters import ExponentialSmoothing
-from statsmodels.tsa.seasonal import seasonal_decompose
 from datetime import timedelta
 import warnings
 from fpdf import FPDF
 import base64
+import hashlib
+import os
+import tempfile
 from io import BytesIO
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
 # Настройки страницы
@@ -19,45 +23,281 @@ st.set_page_config(
     layout="wide"
 )
 
-# Функция загрузки данных
-@st.cache_data
-def load_and_analyze_data(file):
+# Кэш разобранных файлов в Parquet (переживает перезапуск приложения)
+PARQUET_CACHE_DIR = Path(tempfile.gettempdir()) / "sales-smart-cache"
+PARQUET_CACHE_MAX_FILES = 32
+# Версия формата кэша входит в имя файла: после изменения разбора в
+# load_and_analyze_data (колонки, типы, расчет выручки) увеличьте ее,
+# чтобы старые файлы кэша больше не читались
+PARQUET_CACHE_VERSION = 3
+
+# Сохранение разобранного файла в Parquet-кэш; старые файлы удаляются по времени использования
+def save_parquet_cache(df, cache_path):
     try:
-        df = pd.read_excel(file)
+        # Каталог с данными продаж доступен только владельцу процесса
+        PARQUET_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        PARQUET_CACHE_DIR.chmod(0o700)
+        tmp_path = cache_path.with_suffix('.tmp')
+        df.to_parquet(tmp_path, engine='pyarrow', compression='zstd', index=False)
+        tmp_path.replace(cache_path)
         
+        cached_files = sorted(PARQUET_CACHE_DIR.glob('*.parquet'), key=lambda p: p.stat().st_mtime)
+        for old_path in cached_files[:-PARQUET_CACHE_MAX_FILES]:
+            old_path.unlink(missing_ok=True)
+    except Exception:
+        pass
+
+# Хэш содержимого загруженного файла: считается один раз на загрузку
+# и хранится в session_state, дальше служит ключом всех кэшей
+def get_file_hash(uploaded_file):
+    cached = st.session_state.get('uploaded_file_hash')
+    if cached and cached[0] == uploaded_file.file_id:
+        return cached[1]
+    
+    file_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    st.session_state['uploaded_file_hash'] = (uploaded_file.file_id, file_hash)
+    return file_hash
+
+# Функция загрузки данных (кэшируется по хэшу файла, сам файл не хэшируется)
+@st.cache_data
+def load_and_analyze_data(file_hash, _file):
+    try:
         required_columns = ['Дата', 'Объем продаж', 'Вид продукта', 'Местоположение', 'Сумма', 'Тип покупателя']
+        
+        # Тот же файл уже разбирался: читаем готовые колонки из Parquet вместо Excel
+        cache_path = PARQUET_CACHE_DIR / f"{file_hash}-v{PARQUET_CACHE_VERSION}.parquet"
+        if cache_path.exists():
+            try:
+                df = pd.read_parquet(cache_path, columns=required_columns + ['Выручка'])
+                os.utime(cache_path)
+                return None, df
+            except Exception:
+                cache_path.unlink(missing_ok=True)
+        
+        # calamine разбирает xlsx заметно быстрее openpyxl, а текстовые колонки
+        # сразу читаются как категории: группировки и фильтры работают по целым кодам.
+        # Читаем только нужные колонки; usecols-функция не падает на отсутствующих,
+        # поэтому проверка ниже по-прежнему выдает понятное сообщение
+        df = pd.read_excel(
+            _file,
+            engine='calamine',
+            sheet_name=0,
+            usecols=lambda col: col in required_columns,
+            dtype={
+                'Сумма': 'float64',
+                'Вид продукта': 'category',
+                'Местоположение': 'category',
+                'Тип покупателя': 'category'
+            }
+        )
+        
         missing_columns = [col for col in required_columns if col not in df.columns]
         
         if missing_columns:
             return f"Отсутствуют колонки: {', '.join(missing_columns)}", None
         
         df['Дата'] = pd.to_datetime(df['Дата'])
-        df['Выручка'] = df['Объем продаж'] * df['Сумма']
+        # Сортируем один раз при загрузке, чтобы группировки могли работать с sort=False
+        df = df.sort_values('Дата', kind='stable', ignore_index=True)
+        
+        # Объем продаж сужаем до наименьшего целого типа; денежные колонки не сужаем
+        df['Объем продаж'] = pd.to_numeric(df['Объем продаж'], downcast='integer')
+        # Выручка пишется за один проход сразу в готовый буфер; денежные суммы
+        # остаются в float64: во float32 копейки теряются уже в отдельных строках
+        revenue = np.empty(len(df), dtype=np.float64)
+        np.multiply(df['Объем продаж'].to_numpy(), df['Сумма'].to_numpy(), out=revenue)
+        df['Выручка'] = revenue
+        
+        save_parquet_cache(df, cache_path)
         
         return None, df
         
     except Exception as e:
         return f"Ошибка загрузки: {str(e)}", None
 
+# Маска выбранных значений категориальной колонки через таблицу по кодам категорий
+def category_mask(column, selected):
+    # Последний элемент таблицы остается False и отвечает коду -1 (пропуски)
+    lookup = np.zeros(len(column.cat.categories) + 1, dtype=bool)
+    selected_codes = column.cat.categories.get_indexer(list(selected))
+    lookup[selected_codes[selected_codes >= 0]] = True
+    return lookup[column.cat.codes.to_numpy()]
+
+# Фильтрация по периоду, продуктам и локациям одной маской
+# (кэшируется по идентификатору файла и значениям фильтров)
+@st.cache_data(max_entries=16, show_spinner=False)
+def filter_sales(_df, data_key, date_range, products, locations):
+    period_df = _df
+    
+    # Данные отсортированы по дате: период - это непрерывный срез,
+    # границы которого находим бинарным поиском
+    if len(date_range) == 2:
+        start_date, end_date = date_range
+        dates = _df['Дата'].values
+        start = np.searchsorted(dates, np.datetime64(start_date).astype('datetime64[ns]'))
+        end = np.searchsorted(dates, (np.datetime64(end_date) + np.timedelta64(1, 'D')).astype('datetime64[ns]'))
+        period_df = _df.iloc[start:end]
+    
+    mask = category_mask(period_df['Вид продукта'], products)
+    mask &= category_mask(period_df['Местоположение'], locations)
+    
+    return period_df[mask]
+
+# Суммы и средние по категориальной колонке через np.bincount по кодам категорий
+# (в результат попадают только встречающиеся категории)
+def aggregate_by_category(df, column, sum_columns, mean_columns=()):
+    categories = df[column].cat.categories
+    codes = df[column].cat.codes.to_numpy()
+    valid = codes >= 0
+    codes = codes[valid]
+    present = np.bincount(codes, minlength=len(categories)) > 0
+    
+    result = {}
+    for col in sum_columns:
+        values = np.nan_to_num(df[col].to_numpy(dtype=np.float64)[valid])
+        result[col] = np.bincount(codes, weights=values, minlength=len(categories))[present]
+    
+    for col in mean_columns:
+        values = df[col].to_numpy(dtype=np.float64)[valid]
+        finite = ~np.isnan(values)
+        totals = np.bincount(codes[finite], weights=values[finite], minlength=len(categories))
+        counts = np.bincount(codes[finite], minlength=len(categories))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[col] = (totals / counts)[present]
+    
+    return pd.DataFrame(result, index=pd.Index(categories[present], name=column))
+
+# Первые n категорий по значению колонки, остальные сводятся в одну строку "Прочие".
+# Строки упорядочены по возрастанию, "Прочие" идут первыми (внизу горизонтального графика)
+def top_n_with_other(totals, column, n=10, other_label="Прочие"):
+    values = totals[[column]]
+    if len(values) <= n:
+        return values.sort_values(column)
+    
+    top = values.nlargest(n, column)
+    other = pd.DataFrame(
+        {column: [values[column].sum() - top[column].sum()]},
+        index=pd.Index([other_label], name=values.index.name)
+    )
+    return pd.concat([other, top.sort_values(column)])
+
+# Агрегация объема и выручки по дням через np.bincount по номеру дня
+def aggregate_daily(df):
+    days = df['Дата'].values.astype('datetime64[D]')
+    valid = ~np.isnat(days)
+    
+    if not valid.any():
+        return pd.DataFrame(
+            {'Объем продаж': pd.Series(dtype=np.float64), 'Выручка': pd.Series(dtype=np.float64)},
+            index=pd.DatetimeIndex([], name='Дата')
+        )
+    
+    day_numbers = days[valid].view('i8')
+    first_day = day_numbers.min()
+    day_idx = day_numbers - first_day
+    present = np.bincount(day_idx) > 0
+    
+    totals = {
+        col: np.bincount(
+            day_idx,
+            weights=np.nan_to_num(df[col].to_numpy(dtype=np.float64)[valid])
+        )[present]
+        for col in ('Объем продаж', 'Выручка')
+    }
+    dates = (first_day + np.flatnonzero(present)).astype('datetime64[D]').astype('datetime64[ns]')
+    
+    return pd.DataFrame(totals, index=pd.DatetimeIndex(dates, name='Дата'))
+
+# Агрегация объема продаж по локациям и дням
+def aggregate_location_daily(df):
+    loc_codes, loc_names = pd.factorize(df['Местоположение'], sort=True)
+    days = df['Дата'].values.astype('datetime64[D]')
+    valid = (loc_codes >= 0) & ~np.isnat(days)
+    
+    if not valid.any():
+        return pd.DataFrame({
+            'Местоположение': pd.Series(dtype=object),
+            'Дата': pd.Series(dtype='datetime64[ns]'),
+            'Объем продаж': pd.Series(dtype=np.float64)
+        })
+    
+    days = days[valid]
+    first_day = days.min()
+    day_idx = (days - first_day).astype(np.int64)
+    n_loc = len(loc_names)
+    n_days = int(day_idx.max()) + 1
+    
+    # Ячейки (локация x день) за один проход вместо groupby по двум ключам;
+    # как и в groupby, остаются только пары, для которых есть продажи
+    cell_idx = loc_codes[valid] * n_days + day_idx
+    present = np.bincount(cell_idx, minlength=n_loc * n_days) > 0
+    totals = np.bincount(
+        cell_idx,
+        weights=np.nan_to_num(df['Объем продаж'].to_numpy(dtype=np.float64)[valid]),
+        minlength=n_loc * n_days
+    )
+    cells = np.flatnonzero(present)
+    
+    return pd.DataFrame({
+        'Местоположение': np.asarray(loc_names)[cells // n_days],
+        'Дата': (first_day + (cells % n_days)).astype('datetime64[ns]'),
+        'Объем продаж': totals[present]
+    })
+
+# Агрегаты по отфильтрованным данным: считаются один раз и используются
+# во вкладках, рекомендациях и PDF отчете. Кэш привязан к состоянию фильтров,
+# поэтому сам отфильтрованный DataFrame не хэшируется на каждом rerun
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_aggregates(filters_key, _df):
+    # Агрегаты независимы, а редукции NumPy отпускают GIL,
+    # поэтому считаем их параллельно
+    tasks = {
+        'by_date': lambda: aggregate_daily(_df),
+        'by_product': lambda: aggregate_by_category(
+            _df, 'Вид продукта', ['Объем продаж', 'Выручка'], ['Сумма']
+        ),
+        'by_loc': lambda: aggregate_by_category(_df, 'Местоположение', ['Объем продаж', 'Выручка']),
+        'by_cust': lambda: aggregate_by_category(_df, 'Тип покупателя', ['Выручка']),
+        'by_loc_date': lambda: aggregate_location_daily(_df)
+    }
+    
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {name: executor.submit(task) for name, task in tasks.items()}
+        aggregates = {name: future.result() for name, future in futures.items()}
+    
+    # Недельные суммы собираем из дневной матрицы, а не из исходных строк
+    aggregates['by_loc_week'] = aggregates['by_loc_date'].groupby(
+        ['Местоположение', pd.Grouper(key='Дата', freq='W-MON')], sort=False
+    )['Объем продаж'].sum().reset_index()
+    
+    return aggregates
+
+# Обучение модели с учетом сезонности и тренда
+# (кэшируется по хэшу дневного ряда: повторные rerun не переобучают модель)
+@st.cache_resource(max_entries=16, show_spinner=False)
+def fit_forecast(series_key, _values, periods):
+    model = ExponentialSmoothing(
+        _values,
+        seasonal_periods=7,
+        trend='add',
+        seasonal='add',
+        damped_trend=True
+    ).fit(use_brute=False)
+    
+    return model.forecast(periods)
+
 # Улучшенная функция прогнозирования
-def make_forecast(df, periods=30):
+def make_forecast(daily_sales, periods=30):
     try:
-        daily_data = df.groupby('Дата').agg({'Объем продаж': 'sum'}).reset_index()
-        daily_data = daily_data.set_index('Дата').asfreq('D').fillna(0)
+        daily_data = daily_sales.to_frame('Объем продаж').asfreq('D').fillna(0)
         
         if len(daily_data) < 30:
-            return None, "Для прогноза требуется минимум 30 дней данных"
-        
-        # Модель с учетом сезонности и тренда
-        model = ExponentialSmoothing(
-            daily_data['Объем продаж'],
-            seasonal_periods=7,
-            trend='add',
-            seasonal='add',
-            damped_trend=True
-        ).fit()
-        
-        forecast = model.forecast(periods)
+            return None, None, "Для прогноза требуется минимум 30 дней данных"
+        
+        values = daily_data['Объем продаж'].to_numpy(dtype=np.float64)
+        series_key = hashlib.blake2b(values.tobytes(), digest_size=16).hexdigest()
+        forecast = fit_forecast(series_key, values, periods)
+        
         future_dates = pd.date_range(
             start=daily_data.index[-1] + timedelta(days=1),
             periods=periods
@@ -65,152 +305,395 @@ def make_forecast(df, periods=30):
         
         forecast_df = pd.DataFrame({
             'Дата': future_dates,
-            'Объем продаж': forecast,
-            'Тип': 'Прогноз'
-        })
+            'Объем продаж': forecast
+        }, index=future_dates)
         
         actual_df = pd.DataFrame({
             'Дата': daily_data.index,
-            'Объем продаж': daily_data['Объем продаж'],
-            'Тип': 'Факт'
+            'Объем продаж': daily_data['Объем продаж']
         })
         
-        return pd.concat([actual_df, forecast_df]), None
+        # Факт и прогноз возвращаются отдельно, без склейки и последующей фильтрации по типу
+        return actual_df, forecast_df, None
         
     except Exception as e:
-        return None, f"Ошибка прогноза: {str(e)}"
+        return None, None, f"Ошибка прогноза: {str(e)}"
+
+# Границы интервала прогноза: нижняя не опускается ниже нуля (продажи не бывают отрицательными)
+def forecast_band(values, lower=0.8, upper=1.2):
+    return np.maximum(values * lower, 0.0), values * upper
+
+# Построение графика прогноза (кэшируется как словарь фигуры по ключу фильтров:
+# прогноз однозначно определяется отфильтрованными данными, сами таблицы не хэшируются)
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_forecast_fig(filters_key, _actual_df, _forecast_df):
+    actual_dates = _actual_df['Дата'].to_numpy()
+    actual_values = _actual_df['Объем продаж'].to_numpy()
+    forecast_dates = _forecast_df['Дата'].to_numpy()
+    forecast_values = _forecast_df['Объем продаж'].to_numpy(dtype=np.float64)
+    forecast_lower, forecast_upper = forecast_band(forecast_values)
+    
+    fig = go.Figure()
+    
+    # Фактические данные
+    fig.add_trace(go.Scatter(
+        x=actual_dates,
+        y=actual_values,
+        name='Факт',
+        line=dict(color='blue')
+    ))
+    
+    # Прогноз
+    fig.add_trace(go.Scatter(
+        x=forecast_dates,
+        y=forecast_values,
+        name='Прогноз',
+        line=dict(color='red', dash='dot')
+    ))
+    
+    # Доверительный интервал
+    fig.add_trace(go.Scatter(
+        x=forecast_dates,
+        y=forecast_upper,
+        fill=None,
+        mode='lines',
+        line=dict(width=0),
+        showlegend=False
+    ))
+    
+    fig.add_trace(go.Scatter(
+        x=forecast_dates,
+        y=forecast_lower,
+        fill='tonexty',
+        mode='lines',
+        line=dict(width=0),
+        fillcolor='rgba(214,39,40,0.1)',
+        name='Доверительный интервал (±20%)'
+    ))
+    
+    fig.update_layout(
+        title='Прогноз продаж с учетом сезонности',
+        xaxis_title='Дата',
+        yaxis_title='Объем продаж',
+        hovermode='x unified',
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(color='black'),
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        )
+    )
+    
+    return fig.to_dict()
+
+# Графики вкладок (кэшируются как объекты Figure по ключу фильтров:
+# на повторных rerun выполняется только st.plotly_chart)
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_daily_fig(filters_key, _daily):
+    fig = go.Figure(go.Scatter(
+        x=_daily.index.to_numpy(),
+        y=_daily['Объем продаж'].to_numpy(),
+        mode='lines',
+        name='Объем'
+    ))
+    fig.update_layout(title='Динамика продаж', xaxis_title='Дата', yaxis_title='Объем')
+    fig.update_xaxes(tickformat="%d %b", dtick="M1")
+    fig.update_layout(hovermode="x unified")
+    return fig
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_product_figs(filters_key, _by_product):
+    product_df = _by_product.reset_index()
+    
+    bar_fig = px.bar(
+        product_df,
+        x='Вид продукта',
+        y='Объем продаж',
+        title='Продажи по продуктам',
+        color='Вид продукта',
+        text_auto=True
+    )
+    bar_fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(color='black')
+    )
+    
+    scatter_fig = px.scatter(
+        product_df,
+        x='Сумма',
+        y='Объем продаж',
+        size='Объем продаж',
+        color='Вид продукта',
+        title='Цена vs Объем продаж',
+        hover_name='Вид продукта'
+    )
+    scatter_fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(color='black')
+    )
+    return bar_fig, scatter_fig
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def build_location_figs(filters_key, _aggregates):
+    # Горизонтальные столбцы: топ-10 локаций, хвост сводится в "Прочие"
+    revenue_fig = px.bar(
+        top_n_with_other(_aggregates['by_loc'], 'Выручка').reset_index(),
+        x='Выручка',
+        y='Местоположение',
+        orientation='h',
+        title='Выручка по локациям (топ-10)',
+        text_auto='.2s'
+    )
+    revenue_fig.update_traces(textfont_size=12, textangle=0, textposition="outside")
+    
+    # Улучшенный график динамики по локациям
+    area_fig = px.area(
+        _aggregates['by_loc_date'],
+        x='Дата',
+        y='Объем продаж',
+        color='Местоположение',
+        title='Динамика продаж по локациям',
+        facet_col='Местоположение',
+        facet_col_wrap=2,
+        height=600
+    )
+    area_fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(color='black'),
+        showlegend=False
+    )
+    area_fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+    
+    weekly_fig = px.line(
+        _aggregates['by_loc_week'],
+        x='Дата',
+        y='Объем продаж',
+        color='Местоположение',
+        title='Недельная динамика продаж по локациям',
+        markers=True
+    )
+    weekly_fig.update_xaxes(tickformat="%d %b", dtick="M1")
+    weekly_fig.update_layout(hovermode="x unified")
+    return revenue_fig, area_fig, weekly_fig
+
+# Ключевые метрики по всему файлу (кэшируются по ключу данных).
+# Число продуктов берем из категорий колонки без прохода по данным
+@st.cache_data(show_spinner=False)
+def compute_kpis(data_key, _df):
+    return {
+        'total_sales': np.nansum(_df['Объем продаж'].to_numpy()),
+        'total_revenue': np.nansum(_df['Выручка'].to_numpy()),
+        'avg_price': np.nanmean(_df['Сумма'].to_numpy()),
+        'unique_products': len(_df['Вид продукта'].cat.categories)
+    }
 
 # Генерация рекомендаций
-def generate_recommendations(df):
+def generate_recommendations(aggregates):
     recommendations = []
     
-    try:
-        daily_sales = df.groupby('Дата')['Объем продаж'].sum()
-        decomposition = seasonal_decompose(daily_sales, period=7)
+    daily_sales = aggregates['by_date']['Объем продаж']
+    if len(daily_sales) >= 14:
+        # Сезонная составляющая как в seasonal_decompose, но одним проходом NumPy:
+        # убираем тренд центрированным 7-дневным скользящим средним
+        # и усредняем остаток по дням недели
+        daily_sales = daily_sales.asfreq('D', fill_value=0)
+        values = daily_sales.to_numpy(dtype=np.float64)
+        trend = np.convolve(values, np.ones(7) / 7, mode='valid')
+        detrended = values[3:-3] - trend
+        
+        # День недели из числа дней от эпохи (1970-01-01 - четверг, понедельник = 0)
+        epoch_days = daily_sales.index.values[3:-3].astype('datetime64[D]').view('i8')
+        weekdays = ((epoch_days + 3) % 7).astype(np.int8)
+        weekday_profile = (
+            np.bincount(weekdays, weights=detrended, minlength=7)
+            / np.bincount(weekdays, minlength=7)
+        )
         
-        if decomposition.seasonal.std() > (daily_sales.mean() * 0.1):
+        if weekday_profile.std() > (values.mean() * 0.1):
             recommendations.append(
                 "🔍 Выявлена недельная сезонность. Оптимизируйте запасы и персонал соответственно."
             )
-    except:
-        pass
     
-    top_products = df.groupby('Вид продукта')['Объем продаж'].sum().nlargest(3)
-    if len(top_products) > 0:
+    product_sales = aggregates['by_product']['Объем продаж']
+    if len(product_sales) > 0:
+        # Частичная сортировка: три наибольших значения без сортировки всего ряда
+        values = product_sales.to_numpy()
+        k = min(3, len(values))
+        top_idx = np.argpartition(-values, k - 1)[:k]
+        top_idx = top_idx[np.argsort(-values[top_idx], kind='stable')]
+        top_products = product_sales.index[top_idx]
         recommendations.append(
-            f"🏆 Топ-3 продукта: {', '.join(top_products.index)}. Увеличьте их наличие."
+            f"🏆 Топ-3 продукта: {', '.join(top_products)}. Увеличьте их наличие."
         )
     
-    customer_stats = df.groupby('Тип покупателя')['Выручка'].agg(['sum', 'count'])
+    customer_stats = aggregates['by_cust']['Выручка']
     if len(customer_stats) > 1:
-        best_customer = customer_stats['sum'].idxmax()
+        best_customer = customer_stats.index[customer_stats.to_numpy().argmax()]
         recommendations.append(
             f"👥 Основная выручка от '{best_customer}'. Разработайте программу лояльности."
         )
     
-    location_stats = df.groupby('Местоположение')['Выручка'].sum()
+    location_stats = aggregates['by_loc']['Выручка']
     if len(location_stats) > 1:
-        best_loc = location_stats.idxmax()
-        worst_loc = location_stats.idxmin()
+        values = location_stats.to_numpy()
+        best_loc = location_stats.index[values.argmax()]
+        worst_loc = location_stats.index[values.argmin()]
         recommendations.append(
             f"📍 Лучшая локация: {best_loc}, проблемная: {worst_loc}. Изучите причины."
         )
     
     return recommendations if recommendations else ["🔎 Недостаточно данных для рекомендаций"]
 
+# Выгрузка в CSV (кэшируется по ключу фильтров, чтобы не хэшировать
+# и не сериализовать данные на каждом rerun)
+@st.cache_data(max_entries=16, show_spinner=False)
+def to_csv_bytes(filters_key, _df):
+    buffer = BytesIO()
+    _df.to_csv(buffer, index=False, encoding='utf-8', lineterminator='\n')
+    return buffer.getvalue()
+
+# Выгрузка в Parquet: типы колонок сохраняются, файл в разы меньше CSV
+@st.cache_data(max_entries=16, show_spinner=False)
+def to_parquet_bytes(filters_key, _df):
+    buffer = BytesIO()
+    _df.to_parquet(buffer, index=False, compression='zstd')
+    return buffer.getvalue()
+
+# Рендер графиков отчета в PNG под ширину страницы PDF (190 мм ~ 760 px)
+# (кэшируется по содержимому фигур, сам рендер идет параллельно)
+@st.cache_data(max_entries=16, show_spinner=False)
+def render_report_images(figures_key, _figures):
+    with ThreadPoolExecutor(max_workers=len(_figures)) as executor:
+        return list(executor.map(
+            lambda fig: fig.to_image(format="png", width=760, scale=1),
+            _figures
+        ))
+
+# Шрифты для PDF отчета: встроенные шрифты FPDF кодируются в latin-1 и не выводят
+# кириллицу, поэтому подключаем системный TTF (обычный и жирный) с поддержкой Unicode
+PDF_FONT_FAMILY = "ReportSans"
+PDF_FONT_CANDIDATES = [
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"),
+    ("/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf", "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf"),
+    ("C:/Windows/Fonts/arial.ttf", "C:/Windows/Fonts/arialbd.ttf"),
+    ("/System/Library/Fonts/Supplemental/Arial.ttf", "/System/Library/Fonts/Supplemental/Arial Bold.ttf"),
+]
+
+def add_report_fonts(pdf):
+    for regular_path, bold_path in PDF_FONT_CANDIDATES:
+        if os.path.exists(regular_path) and os.path.exists(bold_path):
+            pdf.add_font(PDF_FONT_FAMILY, '', regular_path)
+            pdf.add_font(PDF_FONT_FAMILY, 'B', bold_path)
+            return
+    raise RuntimeError("не найден TTF-шрифт с поддержкой кириллицы (DejaVu Sans, Liberation Sans или Arial)")
+
 # Функция для создания PDF отчета
-def create_pdf_report(df, forecast_df, recommendations, filtered_df):
+def create_pdf_report(kpis, actual_df, forecast_df, recommendations, aggregates):
     pdf = FPDF()
+    add_report_fonts(pdf)
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
+    pdf.set_font(PDF_FONT_FAMILY, size=12)
     
     # Заголовок
-    pdf.set_font("Arial", 'B', 16)
+    pdf.set_font(PDF_FONT_FAMILY, 'B', 16)
     pdf.cell(200, 10, txt="Аналитический отчет по продажам", ln=1, align='C')
     pdf.ln(10)
     
     # Основные метрики
-    pdf.set_font("Arial", 'B', 14)
+    pdf.set_font(PDF_FONT_FAMILY, 'B', 14)
     pdf.cell(200, 10, txt="Ключевые метрики", ln=1)
-    pdf.set_font("Arial", size=12)
+    pdf.set_font(PDF_FONT_FAMILY, size=12)
     
-    total_sales = df['Объем продаж'].sum()
-    total_revenue = df['Выручка'].sum()
-    avg_price = df['Сумма'].mean()
-    unique_products = df['Вид продукта'].nunique()
-    
-    pdf.cell(200, 10, txt=f"Общий объем продаж: {total_sales:,.0f}", ln=1)
-    pdf.cell(200, 10, txt=f"Общая выручка: {total_revenue:,.2f} руб.", ln=1)
-    pdf.cell(200, 10, txt=f"Средний чек: {avg_price:.2f} руб.", ln=1)
-    pdf.cell(200, 10, txt=f"Количество уникальных продуктов: {unique_products}", ln=1)
+    pdf.cell(200, 10, txt=f"Общий объем продаж: {kpis['total_sales']:,.0f}", ln=1)
+    pdf.cell(200, 10, txt=f"Общая выручка: {kpis['total_revenue']:,.2f} руб.", ln=1)
+    pdf.cell(200, 10, txt=f"Средний чек: {kpis['avg_price']:.2f} руб.", ln=1)
+    pdf.cell(200, 10, txt=f"Количество уникальных продуктов: {kpis['unique_products']}", ln=1)
     pdf.ln(10)
     
-    # Графики (сохраняем временные изображения)
-    pdf.set_font("Arial", 'B', 14)
-    pdf.cell(200, 10, txt="Визуализация данных", ln=1)
+    # Графики: сначала строим все фигуры, затем рендерим PNG параллельно
+    figures = []
     
     # Динамика продаж
-    fig = px.line(
-        filtered_df.groupby('Дата').agg({'Объем продаж': 'sum'}).reset_index(),
-        x='Дата',
-        y='Объем продаж',
-        title='Динамика продаж'
-    )
-    img_bytes = fig.to_image(format="png")
-    pdf.image(BytesIO(img_bytes), x=10, w=190)
-    pdf.ln(5)
+    by_date = aggregates['by_date']
+    fig = go.Figure(go.Scatter(
+        x=by_date.index.to_numpy(),
+        y=by_date['Объем продаж'].to_numpy(),
+        mode='lines'
+    ))
+    fig.update_layout(title='Динамика продаж', xaxis_title='Дата', yaxis_title='Объем продаж')
+    figures.append(fig)
     
     # Продукты
-    fig = px.bar(
-        filtered_df.groupby('Вид продукта')['Объем продаж'].sum().reset_index(),
-        x='Вид продукта',
-        y='Объем продаж',
-        title='Продажи по продуктам'
-    )
-    img_bytes = fig.to_image(format="png")
-    pdf.image(BytesIO(img_bytes), x=10, w=190)
-    pdf.ln(5)
+    by_product = aggregates['by_product']
+    fig = go.Figure(go.Bar(
+        x=by_product.index.to_numpy(),
+        y=by_product['Объем продаж'].to_numpy()
+    ))
+    fig.update_layout(title='Продажи по продуктам', xaxis_title='Вид продукта', yaxis_title='Объем продаж')
+    figures.append(fig)
     
     # Локации
-    fig = px.bar(
-        filtered_df.groupby('Местоположение')['Выручка'].sum().reset_index(),
-        x='Местоположение',
-        y='Выручка',
-        title='Выручка по локациям'
-    )
-    img_bytes = fig.to_image(format="png")
-    pdf.image(BytesIO(img_bytes), x=10, w=190)
-    pdf.ln(10)
+    by_loc = aggregates['by_loc']
+    fig = go.Figure(go.Bar(
+        x=by_loc.index.to_numpy(),
+        y=by_loc['Выручка'].to_numpy()
+    ))
+    fig.update_layout(title='Выручка по локациям', xaxis_title='Местоположение', yaxis_title='Выручка')
+    figures.append(fig)
     
     # Прогноз
     if forecast_df is not None:
-        pdf.set_font("Arial", 'B', 14)
-        pdf.cell(200, 10, txt="Прогноз продаж", ln=1)
-        
         fig = go.Figure()
         fig.add_trace(go.Scatter(
-            x=forecast_df[forecast_df['Тип'] == 'Факт']['Дата'],
-            y=forecast_df[forecast_df['Тип'] == 'Факт']['Объем продаж'],
+            x=actual_df['Дата'].to_numpy(),
+            y=actual_df['Объем продаж'].to_numpy(),
             name='Факт',
             line=dict(color='blue')
         ))
         fig.add_trace(go.Scatter(
-            x=forecast_df[forecast_df['Тип'] == 'Прогноз']['Дата'],
-            y=forecast_df[forecast_df['Тип'] == 'Прогноз']['Объем продаж'],
+            x=forecast_df['Дата'].to_numpy(),
+            y=forecast_df['Объем продаж'].to_numpy(),
             name='Прогноз',
             line=dict(color='red', dash='dot')
         ))
-        img_bytes = fig.to_image(format="png")
+        figures.append(fig)
+    
+    figures_key = hashlib.blake2b(
+        ''.join(fig.to_json() for fig in figures).encode('utf-8'),
+        digest_size=16
+    ).hexdigest()
+    images = render_report_images(figures_key, figures)
+    
+    pdf.set_font(PDF_FONT_FAMILY, 'B', 14)
+    pdf.cell(200, 10, txt="Визуализация данных", ln=1)
+    
+    for img_bytes in images[:3]:
         pdf.image(BytesIO(img_bytes), x=10, w=190)
         pdf.ln(5)
+    pdf.ln(5)
+    
+    if forecast_df is not None:
+        pdf.set_font(PDF_FONT_FAMILY, 'B', 14)
+        pdf.cell(200, 10, txt="Прогноз продаж", ln=1)
+        pdf.image(BytesIO(images[3]), x=10, w=190)
+        pdf.ln(5)
     
     # Рекомендации
-    pdf.set_font("Arial", 'B', 14)
+    pdf.set_font(PDF_FONT_FAMILY, 'B', 14)
     pdf.cell(200, 10, txt="Рекомендации", ln=1)
-    pdf.set_font("Arial", size=12)
+    pdf.set_font(PDF_FONT_FAMILY, size=12)
     
     for rec in recommendations:
-        pdf.multi_cell(0, 10, txt=rec)
+        # ln=1 возвращает курсор к левому полю: иначе следующая строка
+        # начинается у правого края и fpdf2 не может ее разместить
+        pdf.multi_cell(0, 10, txt=rec, ln=1)
     
     return pdf
 
@@ -239,27 +722,28 @@ with st.expander("📁 Загрузить данные", expanded=True):
     )
 
 if uploaded_file:
-    error_msg, df = load_and_analyze_data(uploaded_file)
+    data_key = get_file_hash(uploaded_file)
+    error_msg, df = load_and_analyze_data(data_key, uploaded_file)
     
     if error_msg:
         st.error(error_msg)
     else:
         # Основные метрики
-        total_sales = df['Объем продаж'].sum()
-        total_revenue = df['Выручка'].sum()
-        avg_price = df['Сумма'].mean()
-        unique_products = df['Вид продукта'].nunique()
+        kpis = compute_kpis(data_key, df)
         
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("Общий объем", f"{total_sales:,.0f}")
-        col2.metric("Выручка", f"{total_revenue:,.2f} руб.")
-        col3.metric("Средний чек", f"{avg_price:.2f} руб.")
-        col4.metric("Кол-во продуктов", unique_products)
+        col1.metric("Общий объем", f"{kpis['total_sales']:,.0f}")
+        col2.metric("Выручка", f"{kpis['total_revenue']:,.2f} руб.")
+        col3.metric("Средний чек", f"{kpis['avg_price']:.2f} руб.")
+        col4.metric("Кол-во продуктов", kpis['unique_products'])
         
         # Фильтры
         st.sidebar.header("Фильтры")
-        min_date = df['Дата'].min().date()
-        max_date = df['Дата'].max().date()
+        # Данные отсортированы по дате при загрузке (пропуски дат в конце),
+        # поэтому границы берем с краев колонки без полного прохода
+        dates = df['Дата']
+        min_date = dates.iat[0].date()
+        max_date = dates.iat[dates.last_valid_index()].date()
         
         date_range = st.sidebar.date_input(
             "Диапазон дат",
@@ -268,225 +752,95 @@ if uploaded_file:
             max_value=max_date
         )
         
+        # Списки значений для фильтров берем из категорий колонок без прохода по данным
+        product_options = df['Вид продукта'].cat.categories.to_list()
+        location_options = df['Местоположение'].cat.categories.to_list()
+        
         products = st.sidebar.multiselect(
             "Продукты",
-            options=df['Вид продукта'].unique(),
-            default=df['Вид продукта'].unique()
+            options=product_options,
+            default=product_options
         )
         
         locations = st.sidebar.multiselect(
             "Локации",
-            options=df['Местоположение'].unique(),
-            default=df['Местоположение'].unique()
+            options=location_options,
+            default=location_options
         )
         
         # Применение фильтров
-        if len(date_range) == 2:
-            start_date, end_date = date_range
-            filtered_df = df[
-                (df['Дата'].dt.date >= start_date) & 
-                (df['Дата'].dt.date <= end_date) &
-                (df['Вид продукта'].isin(products)) &
-                (df['Местоположение'].isin(locations))
-            ]
-        else:
-            filtered_df = df[
-                (df['Вид продукта'].isin(products)) &
-                (df['Местоположение'].isin(locations))
-            ]
-        
-        # Визуализации
-        tab1, tab2, tab3, tab4 = st.tabs(["Динамика", "Продукты", "Локации", "Прогноз"])
-        
-        with tab1:
-            fig = px.line(
-                filtered_df.groupby('Дата').agg({'Объем продаж': 'sum'}).reset_index(),
-                x='Дата',
-                y='Объем продаж',
-                title='Динамика продаж',
-                labels={'Объем продаж': 'Объем', 'Дата': 'Дата'}
-            )
-            fig.update_xaxes(tickformat="%d %b", dtick="M1")
-            fig.update_layout(hovermode="x unified")
-            st.plotly_chart(fig, use_container_width=True)
+        filters_key = (data_key, tuple(date_range), tuple(products), tuple(locations))
+        filtered_df = filter_sales(df, *filters_key)
+        
+        # Агрегаты для всех вкладок, рекомендаций и отчета
+        aggregates = build_aggregates(filters_key, filtered_df)
+        
+        # Визуализации: st.tabs выполняет тела всех вкладок на каждом перезапуске,
+        # поэтому переключатель разделов строит графики только для выбранного
+        active_tab = st.radio(
+            "Раздел",
+            ["Динамика", "Продукты", "Локации", "Прогноз"],
+            horizontal=True,
+            key='active_tab',
+            label_visibility='collapsed'
+        )
+        
+        if active_tab == "Динамика":
+            daily = aggregates['by_date']
+            st.plotly_chart(build_daily_fig(filters_key, daily), use_container_width=True)
             
             st.dataframe(
-                filtered_df.groupby('Дата').agg({'Объем продаж': 'sum', 'Выручка': 'sum'})
-                .style.format({'Объем продаж': '{:,.0f}', 'Выручка': '₽{:,.2f}'}),
+                daily.style.format({'Объем продаж': '{:,.0f}', 'Выручка': '₽{:,.2f}'}),
                 use_container_width=True
             )
         
-        with tab2:
+        elif active_tab == "Продукты":
+            bar_fig, scatter_fig = build_product_figs(filters_key, aggregates['by_product'])
+            
             col1, col2 = st.columns(2)
             with col1:
-                fig = px.bar(
-                    filtered_df.groupby('Вид продукта')['Объем продаж'].sum().reset_index(),
-                    x='Вид продукта',
-                    y='Объем продаж',
-                    title='Продажи по продуктам',
-                    color='Вид продукта',
-                    text_auto=True
-                )
-                fig.update_layout(
-                    plot_bgcolor='white',
-                    paper_bgcolor='white',
-                    font=dict(color='black')
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(bar_fig, use_container_width=True)
             
             with col2:
-                fig = px.scatter(
-                    filtered_df.groupby('Вид продукта').agg({
-                        'Сумма': 'mean',
-                        'Объем продаж': 'sum'
-                    }).reset_index(),
-                    x='Сумма',
-                    y='Объем продаж',
-                    size='Объем продаж',
-                    color='Вид продукта',
-                    title='Цена vs Объем продаж',
-                    hover_name='Вид продукта'
-                )
-                fig.update_layout(
-                    plot_bgcolor='white',
-                    paper_bgcolor='white',
-                    font=dict(color='black')
-                )
-                st.plotly_chart(fig, use_container_width=True)
-        
-        with tab3:
+                st.plotly_chart(scatter_fig, use_container_width=True)
+        
+        elif active_tab == "Локации":
+            revenue_fig, area_fig, weekly_fig = build_location_figs(filters_key, aggregates)
+            
             st.markdown("### Анализ продаж по локациям")
             
             col1, col2 = st.columns(2)
             with col1:
-                fig = px.bar(
-                    filtered_df.groupby('Местоположение').agg({
-                        'Объем продаж': 'sum',
-                        'Выручка': 'sum'
-                    }).reset_index(),
-                    x='Местоположение',
-                    y='Выручка',
-                    title='Выручка по локациям',
-                    color='Местоположение',
-                    text_auto='.2s'
-                )
-                fig.update_traces(textfont_size=12, textangle=0, textposition="outside")
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(revenue_fig, use_container_width=True)
             
             with col2:
-                # Улучшенный график динамики по локациям
-                loc_df = filtered_df.groupby(['Местоположение', 'Дата'])['Объем продаж'].sum().reset_index()
-                
-                fig = px.area(
-                    loc_df,
-                    x='Дата',
-                    y='Объем продаж',
-                    color='Местоположение',
-                    title='Динамика продаж по локациям',
-                    facet_col='Местоположение',
-                    facet_col_wrap=2,
-                    height=600
-                )
-                
-                fig.update_layout(
-                    plot_bgcolor='white',
-                    paper_bgcolor='white',
-                    font=dict(color='black'),
-                    showlegend=False
-                )
-                
-                fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(area_fig, use_container_width=True)
             
             st.markdown("### Динамика продаж по локациям")
-            fig = px.line(
-                filtered_df.groupby(['Местоположение', pd.Grouper(key='Дата', freq='W-MON')])['Объем продаж'].sum().reset_index(),
-                x='Дата',
-                y='Объем продаж',
-                color='Местоположение',
-                title='Недельная динамика продаж по локациям',
-                markers=True
-            )
-            fig.update_xaxes(tickformat="%d %b", dtick="M1")
-            fig.update_layout(hovermode="x unified")
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(weekly_fig, use_container_width=True)
         
-        with tab4:
+        elif active_tab == "Прогноз":
             st.subheader("Прогноз продаж на 30 дней")
-            forecast_df, forecast_error = make_forecast(filtered_df)
+            actual_df, forecast_df, forecast_error = make_forecast(aggregates['by_date']['Объем продаж'])
             
             if forecast_error:
                 st.warning(forecast_error)
             else:
                 col1, col2 = st.columns([2, 1])
                 with col1:
-                    fig = go.Figure()
-                    
-                    # Фактические данные
-                    fig.add_trace(go.Scatter(
-                        x=forecast_df[forecast_df['Тип'] == 'Факт']['Дата'],
-                        y=forecast_df[forecast_df['Тип'] == 'Факт']['Объем продаж'],
-                        name='Факт',
-                        line=dict(color='blue')
-                    ))
-                    
-                    # Прогноз
-                    fig.add_trace(go.Scatter(
-                        x=forecast_df[forecast_df['Тип'] == 'Прогноз']['Дата'],
-                        y=forecast_df[forecast_df['Тип'] == 'Прогноз']['Объем продаж'],
-                        name='Прогноз',
-                        line=dict(color='red', dash='dot')
-                    ))
-                    
-                    # Доверительный интервал
-                    fig.add_trace(go.Scatter(
-                        x=forecast_df[forecast_df['Тип'] == 'Прогноз']['Дата'],
-                        y=forecast_df[forecast_df['Тип'] == 'Прогноз']['Объем продаж'] * 1.2,
-                        fill=None,
-                        mode='lines',
-                        line=dict(width=0),
-                        showlegend=False
-                    ))
-                    
-                    fig.add_trace(go.Scatter(
-                        x=forecast_df[forecast_df['Тип'] == 'Прогноз']['Дата'],
-                        y=forecast_df[forecast_df['Тип'] == 'Прогноз']['Объем продаж'] * 0.8,
-                        fill='tonexty',
-                        mode='lines',
-                        line=dict(width=0),
-                        fillcolor='rgba(214,39,40,0.1)',
-                        name='Доверительный интервал (±20%)'
-                    ))
-                    
-                    fig.update_layout(
-                        title='Прогноз продаж с учетом сезонности',
-                        xaxis_title='Дата',
-                        yaxis_title='Объем продаж',
-                        hovermode='x unified',
-                        plot_bgcolor='white',
-                        paper_bgcolor='white',
-                        font=dict(color='black'),
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="right",
-                            x=1
-                        )
-                    )
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(build_forecast_fig(filters_key, actual_df, forecast_df), use_container_width=True)
                 
                 with col2:
                     st.markdown("**Детали прогноза**")
                     st.dataframe(
-                        forecast_df[forecast_df['Тип'] == 'Прогноз'][['Дата', 'Объем продаж']]
+                        forecast_df
                         .rename(columns={'Объем продаж': 'Прогноз'})
                         .style.format({'Прогноз': '{:,.0f}'}),
                         height=400
                     )
             
             st.markdown("### Рекомендации")
-            recommendations = generate_recommendations(filtered_df)
+            recommendations = generate_recommendations(aggregates)
             for rec in recommendations:
                 st.success(rec)
         
@@ -494,33 +848,45 @@ if uploaded_file:
         st.sidebar.markdown("---")
         st.sidebar.header("📤 Экспорт")
         
-        # CSV
-        csv = filtered_df.to_csv(index=False).encode('utf-8')
+        # CSV (данные формируются только при нажатии кнопки)
         st.sidebar.download_button(
             label="Скачать CSV",
-            data=csv,
+            data=lambda: to_csv_bytes(filters_key, filtered_df),
             file_name="sales_data.csv",
             mime="text/csv"
         )
         
+        # Parquet (данные формируются только при нажатии кнопки)
+        st.sidebar.download_button(
+            label="Скачать Parquet",
+            data=lambda: to_parquet_bytes(filters_key, filtered_df),
+            file_name="sales_data.parquet",
+            mime="application/octet-stream"
+        )
+        
         # PDF
         if st.sidebar.button("Создать PDF отчет"):
             with st.spinner("Формирование отчета..."):
-                pdf_path = create_pdf_report(
-                    filtered_df,
-                    kpi_text,
-                    figures_for_pdf,
-                    recommendations
-                )
-                
-                with open(pdf_path, "rb") as f:
-                    pdf_bytes = f.read()
-                
-                st.sidebar.download_button(
-                    label="Скачать PDF",
-                    data=pdf_bytes,
-                    file_name="sales_report.pdf",
-                    mime="application/pdf"
-                )
+                # Прогноз и рекомендации считаются и вне вкладки "Прогноз"
+                # (модель берется из кэша, если вкладка уже открывалась)
+                actual_df, forecast_df, _ = make_forecast(aggregates['by_date']['Объем продаж'])
+                try:
+                    pdf = create_pdf_report(
+                        kpis,
+                        actual_df,
+                        forecast_df,
+                        generate_recommendations(aggregates),
+                        aggregates
+                    )
+                    pdf_bytes = bytes(pdf.output())
+                except Exception as e:
+                    pdf_bytes = None
+                    st.sidebar.error(f"Ошибка формирования отчета: {str(e)}")
                 
-                os.unlink(pdf_path)
+                if pdf_bytes is not None:
+                    st.sidebar.download_button(
+                        label="Скачать PDF",
+                        data=pdf_bytes,
+                        file_name="sales_report.pdf",
+                        mime="application/pdf"
+                    )